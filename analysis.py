@@ -1,10 +1,10 @@
 # analyze_into_chess_db.py
 # ------------------------------------------------------------
-# pip install python-chess tqdm
+# pip install python-chess tqdm numpy
 #
 # What it does:
 #   - Reads PGN (many games)
-#   - Runs Stockfish per game (parallel, 1 thread per engine)
+#   - Runs Stockfish per game (a few multi-threaded engines sharing a big hash)
 #   - Computes ACPL + "accuracy-like" (0..100) for White/Black
 #   - Resolves each PGN game to your existing chess.db -> games.id
 #   - Upserts rows into chess.db: analysis(game_id ...), FK -> games(id)
@@ -12,14 +12,16 @@
 # Safe to re-run: it resumes/updates existing rows.
 # ------------------------------------------------------------
 
-import os, sys, time, math, hashlib, sqlite3
+import os, sys, time, hashlib, queue, sqlite3, threading
 from pathlib import Path
 from dataclasses import dataclass
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Iterator, Optional, Tuple
 
+import numpy as np
 import chess
 import chess.pgn
 import chess.engine
+import chess.polyglot
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 
@@ -31,10 +33,16 @@ ENGINE_PATH   = r"C:\Program Files\Stockfish\stockfish.exe"
 
 # Analysis knobs
 MOVETIME_MS     = 20                      # 5–50ms typical
-WORKERS         = max(1, cpu_count() // 2)  # start safely (half your cores)
+# Half your cores in total (as before), split over at most two engines
+ENGINES         = min(2, max(1, cpu_count() // 2))      # engine processes (one per pool worker)
+THREADS_PER_ENGINE = max(1, cpu_count() // 2 // ENGINES)
 SKIP_PLIES      = 0                       # e.g., 10–14 to skip opening
 MAX_PLIES       = None                    # None or int
-ENGINE_HASH_MB  = 256                     # per worker engine hash
+UPSERT_BATCH    = 400                     # analysis rows per executemany
+WRITER_QUEUE_SIZE = 1000                  # finished rows buffered for the writer thread
+ENGINE_HASH_MB  = 256 * THREADS_PER_ENGINE  # per engine; same total as 256MB per single-thread engine
+EVAL_CACHE_ENTRY_BYTES = 100              # measured for dict[int, int] with 64-bit keys
+EVAL_CACHE_MAX  = ENGINE_HASH_MB * 2**20 // 4 // EVAL_CACHE_ENTRY_BYTES  # per worker, ~1/4 of its engine hash
 
 # ---- schema for 'analysis' table in the SAME DB ----
 SCHEMA_SQL = r"""
@@ -57,21 +65,25 @@ CREATE TABLE IF NOT EXISTS analysis (
 
 # ----------------- SQLite helpers -----------------
 def db_connect_rw():
-    con = sqlite3.connect(CHESS_DB_PATH)
+    # autocommit mode; callers manage transactions with explicit BEGIN/COMMIT
+    con = sqlite3.connect(CHESS_DB_PATH, isolation_level=None)
     con.execute("PRAGMA journal_mode=WAL;")
     con.execute("PRAGMA synchronous=NORMAL;")
-    con.executescript(SCHEMA_SQL)
+    con.execute("PRAGMA temp_store=MEMORY;")
+    con.execute("PRAGMA mmap_size=268435456;")  # 256MB
+    con.execute("PRAGMA wal_autocheckpoint=10000;")
     return con
 
-def upsert_analysis_batch(rows: List[Tuple]):
+def ensure_schema(con: sqlite3.Connection):
+    con.executescript(SCHEMA_SQL)
+
+def upsert_analysis_batch(con: sqlite3.Connection, rows: List[Tuple]):
     """
     rows: (game_id, plies_analyzed, acpl_w, acpl_b, acc_w, acc_b, ms_total, engine, movetime_ms, skipped_plies, notes)
     """
     if not rows:
         return
-    con = db_connect_rw()
-    cur = con.cursor()
-    cur.executemany("""
+    con.executemany("""
         INSERT INTO analysis
         (game_id, plies_analyzed, acpl_white, acpl_black, accuracy_white, accuracy_black,
          ms_total, engine, movetime_ms, skipped_plies, notes)
@@ -84,8 +96,37 @@ def upsert_analysis_batch(rows: List[Tuple]):
           movetime_ms=excluded.movetime_ms, skipped_plies=excluded.skipped_plies,
           notes=excluded.notes
     """, rows)
-    con.commit()
-    con.close()
+
+def _analysis_writer(q: queue.Queue, errors: List[BaseException]):
+    # One connection and one transaction for the whole run; None on the queue stops the writer.
+    con = None
+    batch: List[Tuple] = []
+    got_sentinel = False
+    try:
+        con = db_connect_rw()
+        ensure_schema(con)
+        con.execute("BEGIN IMMEDIATE")
+        while True:
+            row = q.get()
+            if row is None:
+                got_sentinel = True
+                break
+            batch.append(row)
+            if len(batch) >= UPSERT_BATCH:
+                upsert_analysis_batch(con, batch)
+                batch.clear()
+        upsert_analysis_batch(con, batch)
+        con.execute("COMMIT")
+    except BaseException as e:
+        errors.append(e)
+        # keep draining so the parent doesn't block on a full queue; once the
+        # sentinel has been taken nothing more will arrive
+        if not got_sentinel:
+            while q.get() is not None:
+                pass
+    finally:
+        if con is not None:
+            con.close()
 
 def parse_pgn_date_to_iso(s: Optional[str]) -> Optional[str]:
     if not s or s.startswith("?"): return None
@@ -98,64 +139,70 @@ def parse_pgn_date_to_iso(s: Optional[str]) -> Optional[str]:
     except Exception:
         return None
 
-def resolve_player_id(cur, name: str) -> Optional[int]:
-    cur.execute("SELECT id FROM players WHERE name=?", (name,))
-    row = cur.fetchone()
-    return row[0] if row else None
+@dataclass
+class GameIndex:
+    """In-memory copy of what resolve_game_id needs, loaded once so the PGN scan issues no SQL."""
+    player_ids: Dict[str, int]
+    games_by_key: Dict[Tuple[int, int, str, str, int], List[int]]  # (w_id, b_id, result, date, plies) -> ids
+    opening_ucis: Dict[int, Tuple[str, ...]]                        # first 10 UCIs of ambiguous games
 
-def resolve_game_id(conn: sqlite3.Connection, tags: Dict[str,str], uci_moves: List[str]) -> Optional[int]:
-    """Try to find the games.id row this PGN game corresponds to."""
+def load_game_index(conn: sqlite3.Connection) -> GameIndex:
     cur = conn.cursor()
+    player_ids = {name: pid for pid, name in cur.execute("SELECT id, name FROM players")}
+
+    games_by_key: Dict[Tuple[int, int, str, str, int], List[int]] = {}
+    for gid, w_id, b_id, res, date, plies in cur.execute("""
+        SELECT id, white_id, black_id, result, date, ply_count FROM games ORDER BY id
+    """):
+        games_by_key.setdefault((w_id, b_id, res, date or "", plies), []).append(gid)
+
+    # only games sharing a key ever need the move probe
+    ambiguous = {gid for ids in games_by_key.values() if len(ids) > 1 for gid in ids}
+    opening: Dict[int, List[str]] = {}
+    if ambiguous:
+        for gid, uci in cur.execute("SELECT game_id, uci FROM moves WHERE ply <= 10 ORDER BY game_id, ply"):
+            if gid in ambiguous:
+                opening.setdefault(gid, []).append(uci)
+    return GameIndex(player_ids, games_by_key, {gid: tuple(u) for gid, u in opening.items()})
+
+def resolve_game_id(index: GameIndex, tags: Dict[str,str], uci_moves: List[str]) -> Optional[int]:
+    """Try to find the games.id row this PGN game corresponds to."""
     white = (tags.get("White") or "Unknown").strip()
     black = (tags.get("Black") or "Unknown").strip()
     res   = tags.get("Result") or "*"
     date_iso = parse_pgn_date_to_iso(tags.get("Date"))
     ply_count = len(uci_moves)
 
-    w_id = resolve_player_id(cur, white)
-    b_id = resolve_player_id(cur, black)
+    w_id = index.player_ids.get(white)
+    b_id = index.player_ids.get(black)
     if w_id is None or b_id is None:
         return None
 
-    if date_iso:
-        cur.execute("""
-            SELECT id FROM games
-            WHERE white_id=? AND black_id=? AND result=? AND date=? AND ply_count=?
-            ORDER BY id
-        """, (w_id, b_id, res, date_iso, ply_count))
-    else:
-        cur.execute("""
-            SELECT id FROM games
-            WHERE white_id=? AND black_id=? AND result=? AND (date IS NULL OR date='') AND ply_count=?
-            ORDER BY id
-        """, (w_id, b_id, res, ply_count))
-    cands = [r[0] for r in cur.fetchall()]
+    cands = index.games_by_key.get((w_id, b_id, res, date_iso or "", ply_count))
     if not cands:
         return None
     if len(cands) == 1:
         return cands[0]
 
     # Disambiguate by first 10 UCIs
-    probe = uci_moves[:10]
+    probe = tuple(uci_moves[:10])
     for gid in cands:
-        cur.execute("SELECT uci FROM moves WHERE game_id=? ORDER BY ply LIMIT ?", (gid, len(probe)))
-        ucis = [r[0] for r in cur.fetchall()]
-        if ucis == probe:
+        if index.opening_ucis.get(gid) == probe:
             return gid
     return cands[0]  # fallback
 
 # ----------------- PGN → jobs -----------------
 @dataclass
 class Job:
+    # kept small: every Job is pickled to a worker
     game_id: int
-    initial_fen: str
-    uci_moves: List[str]
-    tags: Dict[str,str]
+    initial_fen: Optional[str]   # None for the standard starting position
+    uci_moves: bytes             # space-separated ASCII UCI moves
 
-def scan_pgn_and_resolve_jobs(pgn_path: str, conn_for_lookup: sqlite3.Connection) -> List[Job]:
-    jobs: List[Job] = []
+def scan_pgn_and_resolve_jobs(pgn_path: str, index: GameIndex) -> Iterator[Job]:
+    """Yield jobs as the PGN is read, so the pool can start before the scan finishes."""
     with open(pgn_path, encoding="utf-8", errors="ignore") as f, \
-         tqdm(desc=f"Scanning {os.path.basename(pgn_path)}", unit="game") as bar:
+         tqdm(desc=f"Scanning {os.path.basename(pgn_path)}", unit="game", position=1) as bar:
         while True:
             game = chess.pgn.read_game(f)
             if game is None:
@@ -171,19 +218,24 @@ def scan_pgn_and_resolve_jobs(pgn_path: str, conn_for_lookup: sqlite3.Connection
                     ok = False
                     break
             if ok and uci_moves:
-                gid = resolve_game_id(conn_for_lookup, tags, uci_moves)
+                gid = resolve_game_id(index, tags, uci_moves)
                 if gid is not None:
-                    jobs.append(Job(gid, board.fen(), uci_moves, tags))
+                    fen = board.fen()
+                    yield Job(gid, None if fen == chess.STARTING_FEN else fen,
+                              " ".join(uci_moves).encode("ascii"))
             bar.update(1)
-    return jobs
 
 # ----------------- Engine analysis -----------------
 _engine = None
+_eval_cache: Dict[int, int] = {}   # zobrist hash -> score_cp_white, all searched at MOVETIME_MS
 
 def _init_engine():
-    global _engine
+    global _engine, _eval_cache
+    _eval_cache = {}
     _engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
-    _engine.configure({"Threads": 1, "Hash": ENGINE_HASH_MB})
+    # Threads first, Hash last: the TT allocation is done by the already-started threads
+    _engine.configure({"Threads": THREADS_PER_ENGINE})
+    _engine.configure({"Hash": ENGINE_HASH_MB})
 
 def _shutdown_engine():
     global _engine
@@ -200,9 +252,24 @@ def _score_cp_white(eval_):
         return 100000 if mate_ply and mate_ply > 0 else -100000
     return eval_.white().score(mate_score=100000)
 
-def _acpl_to_accuracy(acpl: float) -> float:
-    # Simple monotone map: 0 ACPL -> 100; increases reduce score gently
-    return max(0.0, 100.0 - 0.5 * math.sqrt(max(0.0, acpl)))
+def _eval_white(board: chess.Board, limit: chess.engine.Limit) -> int:
+    """White-POV centipawn eval, reusing cached results for positions seen in earlier games."""
+    h = chess.polyglot.zobrist_hash(board)
+    score = _eval_cache.get(h)
+    if score is not None:
+        return score
+    score = _score_cp_white(_engine.analyse(board, limit)["score"])
+    if len(_eval_cache) >= EVAL_CACHE_MAX:
+        # Hits are mostly shared opening positions, which refill within a few games;
+        # clearing is cheap and avoids per-entry LRU bookkeeping on every lookup.
+        _eval_cache.clear()
+    _eval_cache[h] = score
+    return score
+
+def _acpl_to_accuracy(acpl):
+    # Simple monotone map: 0 ACPL -> 100; increases reduce score gently.
+    # Works element-wise on arrays as well as on scalars.
+    return np.maximum(0.0, 100.0 - 0.5 * np.sqrt(np.maximum(0.0, acpl)))
 
 def _analyze_job(job: Job) -> Tuple[int, int, float, float, float, float, int, str, int, int, Optional[str]]:
     """
@@ -211,21 +278,21 @@ def _analyze_job(job: Job) -> Tuple[int, int, float, float, float, float, int, s
     """
     t0 = time.time()
     notes = []
-    acpl_w = 0.0
-    acpl_b = 0.0
-    n_w = 0
-    n_b = 0
     engine_name = "Stockfish"
 
     try:
-        board = chess.Board(job.initial_fen)
+        board = chess.Board(job.initial_fen or chess.STARTING_FEN)
     except Exception as e:
         return (job.game_id, 0, 0.0, 0.0, 100.0, 100.0, int((time.time()-t0)*1000), engine_name, MOVETIME_MS, SKIP_PLIES, f"bad FEN: {e}")
 
     limit = chess.engine.Limit(time=MOVETIME_MS/1000)
     ply_idx = 0
+    # Each position is evaluated once: the eval after ply N is the eval before ply N+1.
+    # evals_white[i] is the position before the i-th analyzed ply; losses are derived afterwards.
+    evals_white: List[int] = []
+    first_mover_white = True
     try:
-        for u in job.uci_moves:
+        for u in job.uci_moves.decode("ascii").split(" "):
             ply_idx += 1
             if SKIP_PLIES and ply_idx <= SKIP_PLIES:
                 try:
@@ -237,11 +304,10 @@ def _analyze_job(job: Job) -> Tuple[int, int, float, float, float, float, int, s
             if MAX_PLIES and ply_idx > MAX_PLIES:
                 break
 
-            stm_is_white = board.turn == chess.WHITE
-
-            info_best = _engine.analyse(board, limit)
-            s_best_white = _score_cp_white(info_best["score"])
-            s_best_stm = s_best_white if stm_is_white else -s_best_white
+            if not evals_white:
+                # seed on the first analyzed ply
+                first_mover_white = board.turn == chess.WHITE
+                evals_white.append(_eval_white(board, limit))
 
             try:
                 board.push_uci(u)
@@ -249,16 +315,7 @@ def _analyze_job(job: Job) -> Tuple[int, int, float, float, float, float, int, s
                 notes.append(f"illegal move {u} at ply {ply_idx}")
                 break
 
-            info_played = _engine.analyse(board, limit)
-            s_played_white = _score_cp_white(info_played["score"])
-            s_after_stm = s_played_white if (board.turn == chess.WHITE) else -s_played_white
-            s_after_mover = -s_after_stm
-
-            loss = max(0, s_best_stm - s_after_mover)
-            if stm_is_white:
-                acpl_w += abs(loss); n_w += 1
-            else:
-                acpl_b += abs(loss); n_b += 1
+            evals_white.append(_eval_white(board, limit))
 
     except chess.engine.EngineTerminatedError:
         notes.append("engine terminated")
@@ -267,10 +324,16 @@ def _analyze_job(job: Job) -> Tuple[int, int, float, float, float, float, int, s
     except Exception as e:
         notes.append(f"exception: {e}")
 
-    acpl_w = acpl_w / max(1, n_w)
-    acpl_b = acpl_b / max(1, n_b)
-    acc_w = _acpl_to_accuracy(acpl_w)
-    acc_b = _acpl_to_accuracy(acpl_b)
+    # loss from the mover's point of view: eval before minus eval after (never negative)
+    delta = np.diff(np.asarray(evals_white, dtype=np.int64))
+    white_moved = (np.arange(delta.size) % 2 == 0) == first_mover_white
+    losses = np.maximum(0, np.where(white_moved, -delta, delta))
+    losses_w = losses[white_moved]
+    losses_b = losses[~white_moved]
+    n_w, n_b = int(losses_w.size), int(losses_b.size)
+    acpl_w = float(losses_w.mean()) if n_w else 0.0
+    acpl_b = float(losses_b.mean()) if n_b else 0.0
+    acc_w, acc_b = _acpl_to_accuracy(np.array([acpl_w, acpl_b]))
     ms = int((time.time() - t0) * 1000)
     note_str = "; ".join(notes) if notes else None
     return (job.game_id, (n_w+n_b), float(acpl_w), float(acpl_b), float(acc_w), float(acc_b),
@@ -289,43 +352,44 @@ def main():
         print(f"ERROR: chess.db not found at:\n  {CHESS_DB_PATH}")
         sys.exit(1)
 
-    # Ensure analysis table exists
-    con = db_connect_rw()
-    con.close()
-
-    # Build jobs (and resolve to games.id now, in parent)
+    # Load the lookup tables once; jobs are resolved to games.id in the parent while streaming
     con_lookup = sqlite3.connect(CHESS_DB_PATH)
-    jobs = scan_pgn_and_resolve_jobs(PGN_PATH, con_lookup)
+    index = load_game_index(con_lookup)
     con_lookup.close()
-
-    if not jobs:
-        print("No analyzable/resolvable games found.")
-        return
+    jobs = scan_pgn_and_resolve_jobs(PGN_PATH, index)
 
     print(f"DB:       {CHESS_DB_PATH}")
     print(f"PGN:      {PGN_PATH}")
     print(f"ENGINE:   {ENGINE_PATH}")
-    print(f"WORKERS:  {WORKERS}")
+    print(f"ENGINES:  {ENGINES} x {THREADS_PER_ENGINE} threads, {ENGINE_HASH_MB} MB hash")
     print(f"SETTINGS: MOVETIME_MS={MOVETIME_MS}, SKIP_PLIES={SKIP_PLIES}, MAX_PLIES={MAX_PLIES}")
 
-    # Analyze in parallel (workers write nothing; parent batches DB writes)
-    rows: List[Tuple] = []
-    with Pool(processes=WORKERS, initializer=_init_engine) as pool:
-        try:
-            for row in tqdm(pool.imap_unordered(_analyze_job, jobs, chunksize=2),
-                            total=len(jobs), desc="Analyzing", unit="game"):
-                rows.append(row)
-        finally:
-            # workers are terminated by Pool; engines quit in atexit but we guard anyway
-            pass
+    # Analyze in parallel (workers write nothing; a writer thread streams rows into the DB)
+    q: queue.Queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+    errors: List[BaseException] = []
+    writer = threading.Thread(target=_analysis_writer, args=(q, errors), daemon=True)
+    writer.start()
+    n_rows = 0
+    try:
+        # each worker owns one engine for its whole lifetime, so its TT accumulates across jobs
+        with Pool(processes=ENGINES, initializer=_init_engine) as pool:
+            for row in tqdm(pool.imap_unordered(_analyze_job, jobs, chunksize=1),
+                            desc="Analyzing", unit="game", position=0):
+                q.put(row)
+                n_rows += 1
+                if errors:
+                    break
+    finally:
+        q.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
 
-    # Batch upserts
-    rows.sort(key=lambda r: r[0])  # by game_id
-    BATCH = 400
-    for i in range(0, len(rows), BATCH):
-        upsert_analysis_batch(rows[i:i+BATCH])
+    if not n_rows:
+        print("No analyzable/resolvable games found.")
+        return
 
-    print(f"Done. Analyzed {len(rows)} games.")
+    print(f"Done. Analyzed {n_rows} games.")
     print(f"Results are in {CHESS_DB_PATH} (table: analysis).")
 
 if __name__ == "__main__":
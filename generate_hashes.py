@@ -1,33 +1,55 @@
-import sqlite3, hashlib, json, sys
+# requirements:
+#   pip install orjson xxhash
+
+import sqlite3, sys
+import orjson
+import xxhash
 
 DB_PATH = "chess.db"
 TABLE = "games"
 PK = "id"
+BATCH_ROWS = 5000
 
 def compute_row_hash(row_dict):
     # exclude id + self
     row_dict = {k: v for k, v in row_dict.items() if k not in (PK, "row_hash")}
-    # stable JSON (no spaces, sorted keys)
-    serialized = json.dumps(row_dict, sort_keys=True, separators=(",", ":"))
-    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+    # stable JSON (no spaces, sorted keys), serialized straight to bytes
+    serialized = orjson.dumps(row_dict, option=orjson.OPT_SORT_KEYS)
+    # dedup only, not security: a 16-byte xxh3 digest keeps the index keys small
+    return xxhash.xxh3_128_digest(serialized)
 
 def ensure_hash_column(cur):
     cur.execute(f"PRAGMA table_info({TABLE});")
     cols = {r[1] for r in cur.fetchall()}
     if "row_hash" not in cols:
-        cur.execute(f"ALTER TABLE {TABLE} ADD COLUMN row_hash TEXT;")
+        cur.execute(f"ALTER TABLE {TABLE} ADD COLUMN row_hash BLOB;")
 
 def populate_hashes(cur):
-    cur.execute(f"SELECT * FROM {TABLE};")
-    rows = cur.fetchall()
-    total = len(rows)
-    for i, row in enumerate(rows, 1):
-        rd = dict(row)
-        h = compute_row_hash(rd)
-        cur.execute(f"UPDATE {TABLE} SET row_hash=? WHERE {PK}=?", (h, rd[PK]))
-        if i % 1000 == 0:
-            print(f"Processed {i}/{total} rows...")
-    print(f"Updated {total} rows.")
+    cur.execute(f"SELECT COUNT(*) FROM {TABLE};")
+    total = cur.fetchone()[0]
+    done = 0
+    last_pk = None
+    # one transaction for the whole pass; rows are paged by PK and updated in batches
+    cur.execute("BEGIN")
+    while True:
+        if last_pk is None:
+            cur.execute(f"SELECT * FROM {TABLE} ORDER BY {PK} LIMIT ?;", (BATCH_ROWS,))
+        else:
+            cur.execute(f"SELECT * FROM {TABLE} WHERE {PK} > ? ORDER BY {PK} LIMIT ?;",
+                        (last_pk, BATCH_ROWS))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        batch = []
+        for row in rows:
+            rd = dict(row)
+            batch.append((compute_row_hash(rd), rd[PK]))
+        cur.executemany(f"UPDATE {TABLE} SET row_hash=? WHERE {PK}=?", batch)
+        last_pk = batch[-1][1]
+        done += len(batch)
+        print(f"Processed {done}/{total} rows...")
+    cur.execute("COMMIT")
+    print(f"Updated {done} rows.")
 
 def count_duplicates(cur):
     cur.execute(f"""
@@ -41,6 +63,8 @@ def count_duplicates(cur):
     return cur.fetchone()[0]
 
 def add_unique_index(cur):
+    # Created only after populate_hashes: building the index once over finished data is
+    # cheaper than maintaining it through every UPDATE, and lets duplicates be reported first.
     cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{TABLE}_row_hash ON {TABLE}(row_hash);")
 
 def main():
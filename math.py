@@ -10,50 +10,42 @@ def get_data(player_id=PLAYER_ID):
     connection.row_factory = sqlite3.Row
     cursor = connection.cursor()
 
+    # sqlite_stat1 only exists once ANALYZE has run; without it the planner guesses
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    if cursor.fetchone() is None:
+        cursor.execute("ANALYZE games;")
+
+    # ISO dates sort lexicographically, so ORDER BY g.date can walk idx_games_date
     query = """
-    WITH games_union AS (
-        SELECT g.id,
-               g.date AS played_at,
-               g.white_elo AS elo
-        FROM main.games g
-        JOIN analysis a ON a.game_id = g.id
-        WHERE g.date >= '2022-01-01' AND g.white_id = ?
-        UNION ALL
-        SELECT g.id,
-               g.date AS played_at,
-               g.black_elo AS elo
-        FROM main.games g
-        JOIN analysis a ON a.game_id = g.id
-        WHERE g.date >= '2022-01-01' AND g.black_id = ?
-    )
-    SELECT
-        id,
-        played_at,
-        ROUND(julianday(played_at) - MIN(julianday(played_at)) OVER (), 3) AS days,
-        elo
-    FROM games_union
-    ORDER BY julianday(played_at);
+    SELECT g.date AS played_at,
+           CASE WHEN g.white_id = ? THEN g.white_elo ELSE g.black_elo END AS elo
+    FROM main.games g
+    JOIN analysis a ON a.game_id = g.id
+    WHERE g.date >= '2022-01-01' AND (g.white_id = ? OR g.black_id = ?)
+    ORDER BY g.date;
     """
-    cursor.execute(query, (player_id, player_id))
-    rows = cursor.fetchall()
+    cursor.execute(query, (player_id, player_id, player_id))
+    rows = [r for r in cursor.fetchall() if r["elo"] is not None and r["played_at"] is not None]
     connection.close()
 
-    # Return a list of plain dicts
-    return [
-        {"id": r["id"], "played_at": r["played_at"], "days": float(r["days"]), "elo": int(r["elo"])}
-        for r in rows
-        if r["elo"] is not None and r["played_at"] is not None
-    ]
+    # Return columnar arrays (days since first game, elo)
+    played_at = np.array([r["played_at"] for r in rows], dtype="datetime64[D]")
+    days = (played_at - played_at[0]).astype(np.float64) if rows else np.empty(0, dtype=np.float64)
+    elo = np.fromiter((r["elo"] for r in rows), dtype=np.int32, count=len(rows))
+    return days, elo
 
 def main():
-    data = get_data()
-    matrix = np.array([[row["days"], row["elo"]] for row in data])
-    days = matrix[:, 0].astype(float)
-    elo = matrix[:, 1].astype(float)
-
+    days, elo = get_data()
+    elo = elo.astype(np.float64)
 
-    # Least squares fit: elo = m * days + b
-    m, b = np.polyfit(days, elo, 1)
+    # Least squares fit: elo = m * days + b (closed form)
+    n = days.size
+    sx = days.sum()
+    sy = elo.sum()
+    sxx = (days * days).sum()
+    sxy = (days * elo).sum()
+    m = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    b = (sy - m * sx) / n
     print(f"Slope (m): {m:.4f}")
     print(f"Intercept (b): {b:.4f}")
 
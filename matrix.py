@@ -4,14 +4,21 @@
 
 import os, sys
 import datetime as dt
+from itertools import chain
+import queue
 import sqlite3
+import threading
 import chess.pgn
 from tqdm import tqdm
 
 DB_PATH = "lichess.db"
 INPUT_PATH = ""
+STORE_FEN = False   # moves.fen_before is left NULL unless set; it can be rebuilt by replaying uci
 SQUARE_NONE = getattr(chess, "SQUARE_NONE", None)
-SCHEMA_SQL = r"""
+SQUARE_NAMES = tuple(chess.SQUARE_NAMES)
+PIECE_LETTERS = (None, "P", "N", "B", "R", "Q", "K")   # indexed by chess.PieceType
+# Indexes are kept separate so bulk loads can build them once at the end.
+SCHEMA_TABLES_SQL = r"""
 PRAGMA foreign_keys = ON;
 
 CREATE TABLE IF NOT EXISTS players (
@@ -58,50 +65,110 @@ CREATE TABLE IF NOT EXISTS moves (
   to_sq TEXT NOT NULL,                  -- e.g., e4
   piece TEXT NOT NULL,                  -- PNBRQK
   capture INTEGER NOT NULL DEFAULT 0,
-  check   INTEGER NOT NULL DEFAULT 0,
+  is_check INTEGER NOT NULL DEFAULT 0,
   mate    INTEGER NOT NULL DEFAULT 0,
   promotion TEXT,
   fen_before TEXT,
   PRIMARY KEY (game_id, ply),
   FOREIGN KEY(game_id) REFERENCES games(id)
 );
-
+"""
+SCHEMA_INDEXES_SQL = r"""
 CREATE INDEX IF NOT EXISTS idx_games_event   ON games(event_id);
 CREATE INDEX IF NOT EXISTS idx_games_players ON games(white_id, black_id);
 CREATE INDEX IF NOT EXISTS idx_games_date    ON games(date);
 CREATE INDEX IF NOT EXISTS idx_games_elo     ON games(white_elo, black_elo);
 CREATE INDEX IF NOT EXISTS idx_games_eco     ON games(eco);
 """
+DROP_INDEXES_SQL = r"""
+DROP INDEX IF EXISTS idx_games_event;
+DROP INDEX IF EXISTS idx_games_players;
+DROP INDEX IF EXISTS idx_games_date;
+DROP INDEX IF EXISTS idx_games_elo;
+DROP INDEX IF EXISTS idx_games_eco;
+"""
+# Auto mode for deferring indexes: estimate the incoming games from the PGN size and only
+# drop/rebuild when the load is large on its own and at least as big as the existing table.
+PGN_BYTES_PER_GAME = 2048          # all_games.pgn: ~30 MB for ~14k Lichess games
+DEFER_INDEXES_MIN_GAMES = 10_000
+INSERT_GAME_SQL = """
+    INSERT INTO games(event_id, white_id, black_id, result, round, date,
+                      white_elo, black_elo, time_control, termination, eco, opening, ply_count)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+MOVES_COLS = ("game_id, ply, move_number, color, san, uci, from_sq, to_sq, piece, "
+              "capture, is_check, mate, promotion, fen_before")
+MOVES_ROW_PH = "(?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+MOVES_BUFFER_ROWS = 500   # move rows buffered across games before flushing
+MOVES_PER_INSERT = 70     # 70 * 14 params stays under SQLite's default 999 limit
+INSERT_MOVE_SQL = f"INSERT INTO moves({MOVES_COLS}) VALUES {MOVES_ROW_PH}"
+MOVES_MULTI_MIN_ROWS = 32  # tails at or below this go through executemany instead
+INSERT_MOVES_MULTI_SQL = (f"INSERT INTO moves({MOVES_COLS}) VALUES "
+                          + ",".join([MOVES_ROW_PH] * MOVES_PER_INSERT))
+_insert_moves_tail_sql = {}   # n rows -> multi-row INSERT text (stable strings hit sqlite3's statement cache)
+WRITER_QUEUE_SIZE = 8     # parsed games buffered between the parser and the writer thread
+
 def connect():
     import sqlite3
-    conn = sqlite3.connect("chess.db")
+    # autocommit mode; process_pgn manages transactions with explicit BEGIN/COMMIT
+    conn = sqlite3.connect("chess.db", isolation_level=None)
+    fresh = conn.execute("PRAGMA page_count;").fetchone()[0] == 0
+    if fresh:
+        conn.execute("PRAGMA page_size = 8192;")  # only takes effect before the file is initialised
     conn.execute("PRAGMA foreign_keys = ON;")
     conn.execute("PRAGMA journal_mode = WAL;")
     conn.execute("PRAGMA synchronous = NORMAL;")
     conn.execute("PRAGMA cache_size = -50000;")  # ~50MB
     conn.execute("PRAGMA temp_store = MEMORY;")
-    conn.executescript(SCHEMA_SQL)
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256MB
+    conn.execute("PRAGMA wal_autocheckpoint = 10000;")
+    conn.execute("PRAGMA locking_mode = EXCLUSIVE;")
+    if fresh:
+        conn.executescript(SCHEMA_TABLES_SQL)
     return conn
 
-def get_or_create_player_id(cur, name: str) -> int:
+def get_or_create_player_id(cur, name: str, cache=None) -> int:
+    if cache is not None and name in cache:
+        return cache[name]
     cur.execute("SELECT id FROM players WHERE name=?", (name,))
     row = cur.fetchone()
-    if row: return row[0]
-    cur.execute("INSERT INTO players(name) VALUES(?)", (name,))
-    return cur.lastrowid
-
-def get_or_create_event_id(cur, name, site, date_iso):
+    if row:
+        pid = row[0]
+    else:
+        cur.execute("INSERT INTO players(name) VALUES(?)", (name,))
+        pid = cur.lastrowid
+    if cache is not None:
+        cache[name] = pid
+    return pid
+
+def get_or_create_event_id(cur, name, site, date_iso, cache=None):
     if not name:
         return None
+    key = (name, site or "", date_iso or "")
+    if cache is not None and key in cache:
+        return cache[key]
     cur.execute("""
         SELECT id FROM events
         WHERE name=? AND COALESCE(site,'')=COALESCE(?, '') AND COALESCE(start_date,'')=COALESCE(?, '')
     """, (name, site, date_iso))
     row = cur.fetchone()
-    if row: return row[0]
-    cur.execute("INSERT INTO events(name, site, start_date) VALUES(?,?,?)",
-                (name, site, date_iso))
-    return cur.lastrowid
+    if row:
+        eid = row[0]
+    else:
+        cur.execute("INSERT INTO events(name, site, start_date) VALUES(?,?,?)",
+                    (name, site, date_iso))
+        eid = cur.lastrowid
+    if cache is not None:
+        cache[key] = eid
+    return eid
+
+def load_id_caches(cur):
+    """Preload name -> id maps so the per-game lookups only hit SQL for new players/events."""
+    player_cache = {name: pid for pid, name in cur.execute("SELECT id, name FROM players")}
+    event_cache = {(name, site or "", start_date or ""): eid for eid, name, site, start_date
+                   in cur.execute("SELECT id, name, site, start_date FROM events")}
+    return player_cache, event_cache
 
 def parse_pgn_date(s):
     if not s or s.startswith("?"): return None
@@ -117,29 +184,126 @@ def parse_pgn_date(s):
 def bool_i(b): return 1 if b else 0
 
 def insert_game(cur, g):
-    cur.execute("""
-        INSERT INTO games(event_id, white_id, black_id, result, round, date,
-                          white_elo, black_elo, time_control, termination, eco, opening, ply_count)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (g["event_id"], g["white_id"], g["black_id"], g["result"], g["round"], g["date"],
+    cur.execute(INSERT_GAME_SQL, (g["event_id"], g["white_id"], g["black_id"], g["result"], g["round"], g["date"],
           g["white_elo"], g["black_elo"], g["time_control"], g["termination"],
           g["eco"], g["opening"], g["ply_count"]))
     return cur.lastrowid
 
 def insert_moves(cur, rows):
-    cur.executemany("""
-        INSERT INTO moves(game_id, ply, move_number, color, san, uci, from_sq, to_sq, piece,
-                          capture, is_check, mate, promotion, fen_before)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, rows)
-
-def process_pgn(path, commit_every=1000):
-    conn = connect()
-    cur = conn.cursor()
+    # full chunks go through one multi-row VALUES statement; a large tail gets its own
+    # multi-row statement, a small one the single-row statement via executemany
+    n_full = len(rows) - len(rows) % MOVES_PER_INSERT
+    for i in range(0, n_full, MOVES_PER_INSERT):
+        cur.execute(INSERT_MOVES_MULTI_SQL, tuple(chain.from_iterable(rows[i:i + MOVES_PER_INSERT])))
+    tail = rows[n_full:]
+    if len(tail) > MOVES_MULTI_MIN_ROWS:
+        sql = _insert_moves_tail_sql.get(len(tail))
+        if sql is None:
+            sql = _insert_moves_tail_sql[len(tail)] = (f"INSERT INTO moves({MOVES_COLS}) VALUES "
+                                                       + ",".join([MOVES_ROW_PH] * len(tail)))
+        cur.execute(sql, tuple(chain.from_iterable(tail)))
+    elif tail:
+        cur.executemany(INSERT_MOVE_SQL, tail)
+
+def _db_writer(q, commit_every, errors, defer_indexes, est_games):
+    # Owns its own connection; the parser thread never touches the DB.
+    # Items are (white, black, event_name, site, ginfo, moves_rows); None stops the writer.
+    conn = None
+    cur = None
+    move_buf = []
+    count = 0
+    got_sentinel = False
+    dropped_indexes = False
+    try:
+        item = q.get()
+        if item is None:
+            # nothing was parsed (e.g. the parser failed straight away): leave the DB alone
+            got_sentinel = True
+            return
+        conn = connect()
+        cur = conn.cursor()
+        player_cache, event_cache = load_id_caches(cur)
+        if defer_indexes is None:
+            cur.execute("SELECT COUNT(*) FROM games")
+            defer_indexes = est_games >= max(DEFER_INDEXES_MIN_GAMES, cur.fetchone()[0])
+        if defer_indexes:
+            conn.executescript(DROP_INDEXES_SQL)
+            dropped_indexes = True
+        cur.execute("BEGIN IMMEDIATE")
+        while item is not None:
+            white, black, event_name, site, ginfo, moves_rows = item
+            ginfo["white_id"] = get_or_create_player_id(cur, white, player_cache)
+            ginfo["black_id"] = get_or_create_player_id(cur, black, player_cache)
+            ginfo["event_id"] = get_or_create_event_id(cur, event_name, site, ginfo["date"],
+                                                       event_cache)
+            game_id = insert_game(cur, ginfo)
+            if moves_rows:
+                move_buf.extend((game_id,) + r[1:] for r in moves_rows)
+                if len(move_buf) >= MOVES_BUFFER_ROWS:
+                    insert_moves(cur, move_buf)
+                    move_buf.clear()
+
+            count += 1
+            if count % commit_every == 0:
+                insert_moves(cur, move_buf)
+                move_buf.clear()
+                cur.execute("COMMIT")
+                cur.execute("BEGIN IMMEDIATE")
+
+            item = q.get()
+        got_sentinel = True
+
+        insert_moves(cur, move_buf)
+        cur.execute("COMMIT")
+    except BaseException as e:
+        errors.append(e)
+        # keep draining so the parser doesn't block on a full queue; once the
+        # sentinel has been taken the parser is done and nothing more will arrive
+        if not got_sentinel:
+            while q.get() is not None:
+                pass
+    finally:
+        if conn is not None:
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                # rebuild dropped indexes even if the load failed part-way; a fresh DB also
+                # gets its indexes here, after its first games are in
+                if dropped_indexes or count:
+                    conn.executescript(SCHEMA_INDEXES_SQL)
+                if count:
+                    conn.execute("ANALYZE;")
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                # close the cursor first: the re-raised error's traceback keeps this frame
+                # (and cur) alive, and an open statement would keep the EXCLUSIVE lock held
+                if cur is not None:
+                    cur.close()
+                conn.close()
+
+def process_pgn(path, commit_every=1000, defer_indexes=None):
+    """defer_indexes: True/False to force dropping the games indexes during the load,
+    None to decide from the PGN size (see PGN_BYTES_PER_GAME)."""
+    est_games = os.path.getsize(path) // PGN_BYTES_PER_GAME
+    q = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+    errors = []
+    writer = threading.Thread(target=_db_writer,
+                              args=(q, commit_every, errors, defer_indexes, est_games),
+                              daemon=True)
+    writer.start()
+    try:
+        _parse_into(path, q, errors)
+    finally:
+        q.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+def _parse_into(path, q, errors):
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
         game = chess.pgn.read_game(f)
         pbar = tqdm(total=None, desc=f"Parsing {os.path.basename(path)}")
-        count = 0
         while game:
             tags = game.headers
             white = (tags.get("White") or "Unknown").strip()
@@ -160,16 +324,12 @@ def process_pgn(path, commit_every=1000):
             white_elo = to_int(tags.get("WhiteElo"))
             black_elo = to_int(tags.get("BlackElo"))
 
-            white_id = get_or_create_player_id(cur, white)
-            black_id = get_or_create_player_id(cur, black)
-            event_id = get_or_create_event_id(cur, event_name, site, date_iso)
-
             board = game.board()
             moves_rows = []
             ply = 0
             for move in game.mainline_moves():
                 ply += 1
-                fen_before = board.fen()
+                fen_before = board.fen() if STORE_FEN else None
 
                 # Compute SAN first (works even if from-square is empty)
                 try:
@@ -180,20 +340,15 @@ def process_pgn(path, commit_every=1000):
                 uci = move.uci()
 
                 # from/to squares (handle drops/none)
-                if SQUARE_NONE is not None and move.from_square == SQUARE_NONE:
-                    from_sq = "--"  # sentinel for "no origin" (keeps NOT NULL)
-                else:
-                    from_sq = chess.square_name(move.from_square)
-
-                to_sq = chess.square_name(move.to_square)
+                has_origin = SQUARE_NONE is None or move.from_square != SQUARE_NONE
+                from_sq = SQUARE_NAMES[move.from_square] if has_origin else "--"  # "--" keeps NOT NULL
+                to_sq = SQUARE_NAMES[move.to_square]
 
                 # Piece: prefer board lookup; if not present, derive from SAN
-                piece_obj = None
-                if SQUARE_NONE is None or move.from_square != SQUARE_NONE:
-                    piece_obj = board.piece_at(move.from_square)
+                piece_type = board.piece_type_at(move.from_square) if has_origin else None
 
-                if piece_obj is not None:
-                    piece = piece_obj.symbol().upper()
+                if piece_type is not None:
+                    piece = PIECE_LETTERS[piece_type]
                 else:
                     # SAN starts with K,Q,R,B,N for non-pawns; otherwise it's a pawn move
                     if san and len(san) > 0 and san[0] in "KQRBN":
@@ -202,45 +357,42 @@ def process_pgn(path, commit_every=1000):
                         piece = "P"
 
                 # Promotion
-                promo = chess.piece_symbol(move.promotion).upper() if move.promotion else None
-
-                # Flags (check/capture/mate are computed AFTER pushing the move)
-                is_capture = board.is_capture(move)
-                board.push(move)
-                is_chk = board.is_check()
-                is_mate = board.is_checkmate()
+                promo = PIECE_LETTERS[move.promotion] if move.promotion else None
+
+                # Flags: SAN already encodes capture ('x'), check ('+') and mate ('#'),
+                # so only fall back to board queries when SAN failed
+                if san:
+                    is_capture = "x" in san
+                    is_mate = san[-1] == "#"
+                    is_chk = is_mate or san[-1] == "+"
+                    board.push(move)
+                else:
+                    is_capture = board.is_capture(move)
+                    board.push(move)
+                    is_chk = board.is_check()
+                    is_mate = board.is_checkmate()
 
                 move_no = (ply + 1) // 2
-                color = 'W' if ply % 2 == 1 else 'B'
+                color = "WB"[(ply & 1) ^ 1]
 
                 moves_rows.append((
                     None, ply, move_no, color, san, uci, from_sq, to_sq, piece,
-                    1 if is_capture else 0,
-                    1 if is_chk else 0,
-                    1 if is_mate else 0,
+                    int(is_capture), int(is_chk), int(is_mate),
                     promo, fen_before
                 ))
             ginfo = dict(
-                event_id=event_id, white_id=white_id, black_id=black_id, result=result, round=rnd,
+                event_id=None, white_id=None, black_id=None, result=result, round=rnd,
                 date=date_iso, white_elo=white_elo, black_elo=black_elo, time_control=time_control,
                 termination=termination, eco=eco, opening=opening, ply_count=ply
             )
-            game_id = insert_game(cur, ginfo)
-            if moves_rows:
-                moves_rows = [(game_id,) + r[1:] for r in moves_rows]
-                insert_moves(cur, moves_rows)
-
-            count += 1
-            if count % commit_every == 0:
-                conn.commit()
+            q.put((white, black, event_name, site, ginfo, moves_rows))
+            if errors:
+                break
 
             pbar.update(1)
             game = chess.pgn.read_game(f)
 
-        conn.commit()
         pbar.close()
-    cur.close()
-    conn.close()
 
 if __name__ == "__main__":
     process_pgn(INPUT_PATH)